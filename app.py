@@ -1,107 +1,149 @@
 import streamlit as st
 import yfinance as yf
-from prophet import Prophet
-import plotly.graph_objects as go
+from yfinance.exceptions import YFRateLimitError
 import pandas as pd
+import numpy as np
 from supabase import create_client, Client
 import hashlib
+import time
+from curl_cffi.requests.exceptions import RequestException
 from datetime import datetime
-from deep_translator import GoogleTranslator
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Supabase 接続設定 ---
-url: str = st.secrets["SUPABASE_URL"]
-key: str = st.secrets["SUPABASE_KEY"]
-supabase: Client = create_client(url, key)
+@st.cache_resource
+def get_supabase() -> Client:
+    url: str = st.secrets["SUPABASE_URL"]
+    key: str = st.secrets["SUPABASE_KEY"]
+    return create_client(url, key)
 
-@st.cache_data(ttl=3600)
-def fetch_stock_data(symbol, period):
-    return yf.download(symbol, period=period)
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_prices(symbol, period_years):
+    """株価を取得し、Prophet 用の ds / y 形式に整形して返す（利用制限時は例外を送出し、結果をキャッシュしない）"""
+    # yf.download は利用制限も空のデータとして返すため、例外を送出する Ticker.history を使う
+    data = call_with_retry(lambda: yf.Ticker(symbol).history(period=f"{period_years}y"))
+    if data.empty:
+        return pd.DataFrame(columns=['ds', 'y'])
+
+    # 取引所のタイムゾーン付きで返るため、現地の日付のままタイムゾーンを外す
+    dates = data.index
+    if dates.tz is not None:
+        dates = dates.tz_localize(None)
+    return pd.DataFrame({'ds': dates.to_numpy(), 'y': data['Close'].to_numpy()})
+
+@st.cache_resource(ttl=3600, max_entries=32, show_spinner=False)
+def fit_prophet(symbol, period_years, data_len, last_date, _df_train):
+    """学習済みの Prophet モデルを返す（データ件数・最終日が変わるか、株価と同じ1時間が経過したら再学習）"""
+    from prophet import Prophet
+
+    model = Prophet(daily_seasonality=False, weekly_seasonality=True, yearly_seasonality=True, changepoint_prior_scale=0.05, uncertainty_samples=200)
+    model.fit(_df_train)
+    return model
 
 def make_hashes(password):
-    return hashlib.sha256(str.encode(password)).hexdigest()
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
 
-def get_company_name(symbol):
-    """銘柄コードから企業名を取得する"""
+# yfinance の通信（curl_cffi 経由）で起こる一時的な失敗
+RETRYABLE_ERRORS = (YFRateLimitError, RequestException)
+
+def call_with_retry(func):
+    """一時的な通信エラーの場合は1秒待って1回だけ再試行する"""
     try:
-        ticker = yf.Ticker(symbol)
-        info = ticker.info
-        # 米国株・日本株どちらでも対応できるよう、優先順位をつけて取得
-        company_name = info.get('longName') or info.get('shortName') or symbol
-        return company_name
-    except :
-        return symbol
+        return func()
+    except RETRYABLE_ERRORS:
+        time.sleep(1)
+        return func()
+
+# 利用制限・通信エラーの後、Yahoo への問い合わせを控える時間（秒）
+YAHOO_BACKOFF_SECONDS = 60
 
+def yahoo_backing_off():
+    """直前の失敗から待ち時間が経過していなければ True を返す"""
+    return time.time() < st.session_state.get('yahoo_retry_after', 0)
+
+def start_yahoo_backoff():
+    st.session_state['yahoo_retry_after'] = time.time() + YAHOO_BACKOFF_SECONDS
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def get_company_name(symbol):
+    """銘柄コードから企業名を取得する（取得に失敗した場合は例外を送出し、結果をキャッシュしない）"""
+    info = call_with_retry(lambda: yf.Ticker(symbol).info)
+    # 米国株・日本株どちらでも対応できるよう、優先順位をつけて取得
+    return info.get('longName') or info.get('shortName') or symbol
+
+@st.cache_data(ttl=86400, max_entries=1024, show_spinner=False)
 def translate_to_english(text):
-    """日本語を英語に翻訳する（英数字のみの場合はそのまま）"""
-    try:
-        # 入力が日本語（ひらがな、カタカナ、漢字）を含むかチェック
-        if any(ord(char) > 255 for char in text):
-            translated = GoogleTranslator(source='auto', target='en').translate(text)
-            return translated
-        return text
-    except:
-        return text
+    """日本語を英語に翻訳する（英数字のみの場合はそのまま。翻訳に失敗した場合は例外を送出）"""
+    # 入力が日本語（ひらがな、カタカナ、漢字）を含むかチェック
+    if not text.isascii() and max(text) > '\xff':
+        from deep_translator import GoogleTranslator
+        return GoogleTranslator(source='auto', target='en').translate(text)
+    return text
 
+@st.cache_data(ttl=600, show_spinner=False)
 def search_tickers(query):
-    """企業名やキーワードから銘柄候補を取得する"""
-    try:
-        english_query = translate_to_english(query)
-        search = yf.Search(english_query, max_results=5)
-        results = []
-        for quote in search.quotes:
-            symbol = quote.get('symbol')
-            name = quote.get('longname') or quote.get('shortname') or symbol
-            exch = quote.get('exchDisp') or ""
-            results.append({"label": f"{symbol}: {name} ({exch})", "symbol": symbol})
-        return results
-    except Exception as e:
-        return []
+    """英語のキーワードから銘柄候補を取得する（取得に失敗した場合は例外を送出し、結果をキャッシュしない）"""
+    search = call_with_retry(lambda: yf.Search(query, max_results=5))
+    results = []
+    for quote in search.quotes:
+        symbol = quote.get('symbol')
+        name = quote.get('longname') or quote.get('shortname') or symbol
+        exch = quote.get('exchDisp') or ""
+        results.append({"label": f"{symbol}: {name} ({exch})", "symbol": symbol})
+    return results
 
 # --- データベース操作関数 ---
 def create_user(username, password):
     data = {"username": username, "password": make_hashes(password)}
-    supabase.table("users").insert(data).execute()
+    get_supabase().table("users").insert(data).execute()
 
 def login_user(username, password):
-    response = supabase.table("users").select("*")\
+    hashed_password = make_hashes(password)
+    response = get_supabase().table("users").select("username")\
         .eq("username", username)\
-        .eq("password", make_hashes(password))\
+        .eq("password", hashed_password)\
+        .limit(1)\
         .execute()
-    return response.data
+    return bool(response.data)
 
 def add_history(username, symbol):
     data = {"username": username, "symbol": symbol}
-    supabase.table("history").insert(data).execute()
+    get_supabase().table("history").insert(data).execute()
+    get_history.clear(username)
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_history(username):
-    response = supabase.table("history").select("symbol")\
+    response = get_supabase().table("recent_history").select("symbol")\
         .eq("username", username)\
-        .order("timestamp", desc=True)\
+        .order("ts", desc=True)\
         .limit(5)\
         .execute()
-    return list(dict.fromkeys([item['symbol'] for item in response.data]))
+    return [item['symbol'] for item in response.data]
 
 def add_favorite(username, symbol):
     try:
         data = {"username": username, "symbol": symbol}
-        supabase.table("favorites").insert(data).execute()
+        get_supabase().table("favorites").insert(data).execute()
+        get_favorites.clear(username)
         return True
-    except:
+    except Exception:
         return False
 
 def remove_favorite(username, symbol):
-    supabase.table("favorites").delete().eq("username", username).eq("symbol", symbol).execute()
+    get_supabase().table("favorites").delete().eq("username", username).eq("symbol", symbol).execute()
+    get_favorites.clear(username)
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_favorites(username):
-    response = supabase.table("favorites").select("symbol").eq("username", username).execute()
+    response = get_supabase().table("favorites").select("symbol").eq("username", username).execute()
     return [item['symbol'] for item in response.data]
     
 def delete_account(username):
     """ユーザーに関連するすべてのデータを削除する"""
     try:
-        supabase.table("history").delete().eq("username", username).execute()
-        supabase.table("favorites").delete().eq("username", username).execute()
-        supabase.table("users").delete().eq("username", username).execute()
+        get_supabase().rpc("delete_account", {"uname": username}).execute()
+        get_history.clear(username)
+        get_favorites.clear(username)
         return True
     except Exception as e:
         st.error(f"削除エラー: {e}")
@@ -138,7 +180,7 @@ def main():
                 try:
                     create_user(new_user, new_password)
                     st.success("アカウントを作成しました。ログインしてください。")
-                except:
+                except Exception:
                     st.error("そのユーザー名は既に使用されています")
     else:
         st.sidebar.success(f"ログイン中: {st.session_state['username']}")
@@ -167,7 +209,6 @@ def main():
                     if 'ticker_search_input' in st.session_state:
                         st.session_state['ticker_search_input'] = ""
                     st.session_state['is_valid_symbol'] = False
-                    st.rerun()
 
         st.sidebar.markdown("---")
         st.sidebar.subheader("🕒 最近の検索")
@@ -179,11 +220,15 @@ def main():
                     if 'ticker_search_input' in st.session_state:
                         st.session_state['ticker_search_input'] = ""
                     st.session_state['is_valid_symbol'] = False
-                    st.rerun()
 
-        show_stock_predict_ui()
+        # サイドバーのボタンで設定した銘柄は、この実行内で下の予測画面に反映される
+        show_stock_predict_ui(favs)
+
+# 検索・予測画面の操作では、この部分だけを再実行する
+@st.fragment
+def show_stock_predict_ui(favs):
+    import plotly.graph_objects as go
 
-def show_stock_predict_ui():
     if 'search_symbol' not in st.session_state:
         st.session_state['search_symbol'] = 'AAPL'
     
@@ -191,15 +236,28 @@ def show_stock_predict_ui():
         st.session_state['is_valid_symbol'] = False
 
     st.title("📈 株価推移予測ダッシュボード")
-    favs = get_favorites(st.session_state['username'])
    
     st.subheader("🔍 銘柄を検索・選択")
     search_query = st.text_input("企業名を入力（例: トヨタ, Apple）", key="ticker_search_input")
     
     selected_symbol = None
     if search_query:
-        search_results = search_tickers(search_query)
-        if search_results:
+        # 失敗時の代替値はキャッシュせず、ここで適用する
+        try:
+            english_query = translate_to_english(search_query)
+        except Exception:
+            english_query = search_query
+        search_results = None
+        if not yahoo_backing_off():
+            try:
+                search_results = search_tickers(english_query)
+            except RETRYABLE_ERRORS:
+                start_yahoo_backoff()
+            except Exception:
+                search_results = []
+        if search_results is None:
+            st.info("Yahoo Finance に接続できないため検索できませんでした。しばらくしてから再度お試しください。")
+        elif search_results:
             options = [item['label'] for item in search_results]
             selected_option = st.selectbox("検索結果から選択してください", options)
             selected_symbol = selected_option.split(":")[0]
@@ -251,43 +309,56 @@ def show_stock_predict_ui():
             try:
                 with st.spinner('最新データを取得中...'):
                     # ここで銘柄の妥当性を確認
-                    data = fetch_stock_data(symbol, f"{period}y")
+                    try:
+                        df_train = load_prices(symbol, period)
+                    except RETRYABLE_ERRORS:
+                        start_yahoo_backoff()
+                        df_train = None
                 
-                if data.empty or len(data) < 10:
+                if df_train is None or df_train.empty or len(df_train) < 10:
                     st.error(f"銘柄コード '{symbol}' のデータが見つからないか、少なすぎます。")
                     st.session_state['is_valid_symbol'] = False
                 else:
                     st.session_state['is_valid_symbol'] = True
-                    add_history(st.session_state['username'], symbol)
-                    
-                    # 予測実行のフローの中で企業名を再取得し、表示を確定させる
-                    with st.spinner('企業情報を取得中...'):
-                        company_name = get_company_name(symbol)
-                    st.subheader(f"🏢 企業名: {company_name}")
-                    # ---------------------------
-                    
-                    df_train = data.reset_index()
-                    if isinstance(df_train.columns, pd.MultiIndex):
-                        df_train.columns = df_train.columns.get_level_values(0)
-                    
-                    df_train = df_train[['Date', 'Close']]
-                    df_train.columns = ['ds', 'y']
-                    df_train['ds'] = df_train['ds'].dt.tz_localize(None)
-
-                    with st.spinner('解析中...'):
-                        model = Prophet(daily_seasonality=True, weekly_seasonality=True, yearly_seasonality=True, changepoint_prior_scale=0.05)
-                        model.fit(df_train)
-                        future = model.make_future_dataframe(periods=10)
-                        future['day_of_week'] = future['ds'].dt.dayofweek
-                        future = future[future['day_of_week'] < 5]
-                        forecast = model.predict(future)
+                    if execute_btn:
+                        add_history(st.session_state['username'], symbol)
+                        # 予測画面はフラグメントのため、サイドバーの「最近の検索」を更新するにはアプリ全体を再実行する
+                        st.rerun()
+
+                    # 企業名の取得（Yahoo への通信）は、実在する銘柄と確認できてから予測と並行して行う
+                    name_header = st.empty()
+                    with ThreadPoolExecutor(max_workers=1) as executor:
+                        # 利用制限中は企業名を問い合わせず、銘柄コードで代用する
+                        name_task = None if yahoo_backing_off() else executor.submit(get_company_name, symbol)
+
+                        with st.spinner('解析中...'):
+                            last_date = df_train['ds'].iloc[-1]
+                            model = fit_prophet(symbol, period, len(df_train), last_date, df_train)
+                            # 直近10日間のうち平日のみを予測対象にする
+                            future_ds = pd.bdate_range(last_date + pd.Timedelta(days=1), last_date + pd.Timedelta(days=10))
+                            future = pd.concat([df_train[['ds']], pd.DataFrame({'ds': future_ds})], ignore_index=True)
+                            forecast = model.predict(future)
+
+                        company_name = symbol
+                        if name_task is not None:
+                            with st.spinner('企業情報を取得中...'):
+                                try:
+                                    company_name = name_task.result()
+                                except RETRYABLE_ERRORS:
+                                    start_yahoo_backoff()
+                                except Exception:
+                                    pass
+                        if yahoo_backing_off():
+                            st.info("Yahoo Finance に接続できないため、企業名の代わりに銘柄コードを表示しています。")
+                    name_header.subheader(f"🏢 企業名: {company_name}")
 
                     fig = go.Figure()
-                    fig.add_trace(go.Scatter(x=df_train['ds'], y=df_train['y'], name="実績値", line=dict(color='#1f77b4')))
-                    fig.add_trace(go.Scatter(x=forecast['ds'], y=forecast['yhat'], name="予測値", line=dict(color='#e377c2', dash='dash')))
-                    fig.add_trace(go.Scatter(
-                        x=pd.concat([forecast['ds'], forecast['ds'][::-1]]),
-                        y=pd.concat([forecast['yhat_upper'], forecast['yhat_lower'][::-1]]),
+                    fig.add_trace(go.Scattergl(x=df_train['ds'], y=df_train['y'], name="実績値", line=dict(color='#1f77b4')))
+                    fig.add_trace(go.Scattergl(x=forecast['ds'], y=forecast['yhat'], name="予測値", line=dict(color='#e377c2', dash='dash')))
+                    ds_arr = forecast['ds'].to_numpy()
+                    fig.add_trace(go.Scattergl(
+                        x=np.concatenate([ds_arr, ds_arr[::-1]]),
+                        y=np.concatenate([forecast['yhat_upper'].to_numpy(), forecast['yhat_lower'].to_numpy()[::-1]]),
                         fill='toself', fillcolor='rgba(227,119,194,0.1)', line=dict(color='rgba(255,255,255,0)'),
                         name="予測範囲"
                     ))
@@ -298,7 +369,12 @@ def show_stock_predict_ui():
                     st.write("### 予測価格の詳細")
                     res_df = forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(7)
                     res_df.columns = ['日付', '予測価格', '最低予想', '最高予想']
-                    st.dataframe(res_df.style.format({"予測価格": "{:.2f}", "最低予想": "{:.2f}", "最高予想": "{:.2f}"}))
+                    price_column = st.column_config.NumberColumn(format="%.2f")
+                    st.dataframe(
+                        res_df,
+                        column_config={"予測価格": price_column, "最低予想": price_column, "最高予想": price_column},
+                        width="stretch",
+                    )
                     st.write("###### ※このチャートは推移傾向の目安のため、実際の変動とは異なる場合があります")
 
             except Exception as e:
@@ -0,0 +1,9 @@
+-- ユーザーに関連するすべてのデータを1回のRPCでまとめて削除する
+create or replace function public.delete_account(uname text)
+returns void
+language sql
+as $$
+  delete from public.history where username = uname;
+  delete from public.favorites where username = uname;
+  delete from public.users where username = uname;
+$$;
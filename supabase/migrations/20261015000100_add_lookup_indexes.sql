@@ -0,0 +1,7 @@
+-- 最近の検索（get_history）: username で絞り込み、timestamp の降順で上位5件
+create index if not exists history_user_ts_idx on public.history (username, "timestamp" desc);
+
+-- お気に入り一覧（get_favorites）
+create index if not exists favorites_user_idx on public.favorites (username);
+
+-- users.username は既存の一意制約（新規登録の重複チェックで使用）のインデックスを利用する
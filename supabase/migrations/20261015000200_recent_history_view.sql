@@ -0,0 +1,7 @@
+-- ユーザーごと・銘柄ごとに最新の検索日時を1行にまとめたビュー
+create or replace view public.recent_history
+with (security_invoker = true)
+as
+select username, symbol, max("timestamp") as ts
+from public.history
+group by username, symbol;